@@ -1,11 +1,18 @@
 import os
 import json
+import hashlib
 import logging
 from pathlib import Path
 import fitz  # PyMuPDF
 import re
-from typing import List, Dict, Any, Tuple, Optional
+import math
+from typing import List, Dict, Any, Tuple, Optional, Iterable, Iterator, Union, AbstractSet
 from enum import Enum, auto
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
 # Import from config
 from config import PROJECT_ROOT, PROCESSED_DATA_DIR
 
@@ -25,9 +32,11 @@ PROCESSED_DATA_DIR.mkdir(parents=True, exist_ok=True) # Ensure it exists if conf
 
 # It's good practice to define constants for directory names
 IMAGES_BASE_SUBDIR = "images_from_pdf" # Renamed to avoid conflict if you have other "images" dirs
+IMAGE_WRITE_WORKERS = 4 # 背景寫入圖片檔的執行緒數
+PARSE_CACHE_SUBDIR = ".parse_cache" # 題目卷解析結果的快取目錄 (位於 PROCESSED_DATA_DIR 下)
 
 # --- Regex Pattern Strings (Module Level) ---
-# Used by determine_parsing_mode and then compiled in parsing functions
+# Used by determine_parsing_mode; compiled once below and shared by the parsing functions
 DEFAULT_QUESTION_START_REGEX_STR = r"^\s*(\d+)\s*\u002E\s*(.*)"
 STRICT_QUESTION_START_REGEX_STR = r"^\s*(\d+)\s*\u002E(?!\d)\s*(.*)"
 OPTION_REGEX_STR = (
@@ -39,19 +48,86 @@ OPTION_REGEX_STR = (
 # Anchored version for matching at the beginning of a block
 ANCHORED_OPTION_REGEX_STR = OPTION_REGEX_STR # Already starts with ^\s* effectively
 
+# 預先編譯的題號 / 選項模式 (模組載入時編譯一次，逐行、逐區塊比對時直接使用)
+_DEFAULT_QUESTION_START_RE = re.compile(DEFAULT_QUESTION_START_REGEX_STR)
+_STRICT_QUESTION_START_RE = re.compile(STRICT_QUESTION_START_REGEX_STR)
+_OPTION_RE = re.compile(OPTION_REGEX_STR)
+_ANCHORED_OPTION_RE = re.compile(ANCHORED_OPTION_REGEX_STR)
+# parsing_mode -> 題號模式 (未列出的模式一律使用 default)
+_QUESTION_START_PATTERNS = {
+    "default": _DEFAULT_QUESTION_START_RE,
+    "strict_start": _STRICT_QUESTION_START_RE,
+}
+
+# --- 答案卷備註區的模式 ---
+# 套用順序與優先權依 _NOTE_PATTERNS 的順序 (後者覆寫前者)
+_NOTE_ANCHOR_RE = re.compile(r"第\d")
+_NOTE_CORRECT_RE = re.compile(r"第(\d+)題[，,，、及和與]*(?:答案|選項)?(?:更正為|應為)?([A-D#\uFF03])(?:.*?)。")
+_NOTE_BONUS_RE = re.compile(r"第(\d+)題[，,，]?(送分|均給分|皆給分|給分)")
+_NOTE_GENERIC_RE = re.compile(r"第(\d+)題[，,，]?(?!送分|均給分|皆給分|給分|答案更正為|選項更正為|應為)([^第].*?)。")
+_MULTI_Q_NOTE_RE = re.compile(r"第(\d+(?:[、,及和與]\d+)*)題(?:(?:等)|(?:各題))?[，,，]?(送分|均給分|皆給分|給分|(?:答案|選項)?(?:更正為|應為)?([A-D#\uFF03]))(?:.*?)。")
+_NOTE_PATTERNS = (_NOTE_CORRECT_RE, _NOTE_BONUS_RE, _NOTE_GENERIC_RE, _MULTI_Q_NOTE_RE)
+
+# --- 答案卷表格與備註區的其他模式 ---
+_ANSWER_CHAR_RE = re.compile(r"[A-Z\uFF21-\uFF3A#\uFF03]") # 單一答案字元 (半形/全形字母或 #)
+# 與 _ANSWER_CHAR_RE 相同的字元集合；逐字判斷單一字元時用集合查詢，不必每個字都跑一次 regex
+_ANSWER_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ#\uFF03") | frozenset(chr(c) for c in range(0xFF21, 0xFF3B))
+_DIGITS_RE = re.compile(r"\d+")
+
+# --- 檔名 / 路徑用的模式 ---
+_FILENAME_YEAR_PERIOD_RE = re.compile(r"(\d{3,4})年[_ ]*第?(\d+)次")
+_FILENAME_YEAR_PERIOD_SHORT_RE = re.compile(r"(\d{3,4})[ _-]?([1-4])")
+# 科目全名 → 簡稱的分隔字，依序優先 (例："臨床血液學與血庫學" → "臨床血液學")
+_SUBJECT_NAME_SEPARATORS = ("與", "和", "及")
+# sanitize_for_filesystem 的逐字元替換/刪除表 (str.translate 在 C 層一次走完字串，不必跑 regex)
+_FS_UNSAFE_TO_UNDERSCORE = str.maketrans(dict.fromkeys('\\/:*?"<>|', '_'))
+# 與原本的 r'[\\x00-\\x1F\\x7F]' 實際比對到的字元相同：raw 字串裡的雙反斜線讓它成為 '0'-'\\' 範圍加上 'x'，
+# 並非真正的控制字元。保留原行為，以免既有輸出目錄名稱改變
+_FS_CONTROL_CHARS_DELETE = str.maketrans("", "", "".join(map(chr, range(ord('0'), ord('\\') + 1))) + "x")
+_FS_UNDERSCORE_RUN_RE = re.compile(r'_+')
+
+# --- 首頁元數據模式 ---
+# 每個欄位包在 lookahead 中：不消耗字元，各欄位仍各自取得最左邊的 match (同獨立 re.search)，
+# 但整份文字只需掃描一次。各欄位開頭字元互不相同，因此同一位置最多只有一個欄位成立。
+_META_FIELDS_RE = re.compile(
+    r"(?=(?P<code>代[　\s]*號[：: ]*(?P<code_val>[0-9]+)))"
+    r"|(?=(?P<stype>類科名稱[：: ]*(?P<stype_val>[\S ]+)))"
+    r"|(?=(?P<sname>科目名稱[：: ]*(?P<sname_val>[\S ]+)))"
+    r"|(?=(?P<yp>(?P<yp_year>\d{3,4})年[ _]*第?(?P<yp_period>\d+)次))"
+    r"|(?=(?P<qcount>題[\s　]*數[：: ]*(?P<qcount_val>\d+)))"
+)
+_META_FIELD_COUNT = 5
+
+# 全形 Ａ-Ｚ → 半形 A-Z 的轉換表 (供 str.translate 使用)
+_FULLWIDTH_TO_ASCII = str.maketrans({chr(0xFF21 + i): chr(ord('A') + i) for i in range(26)})
+# 全形 Ａ-Ｚ、ａ-ｚ → 半形，供 normalize_full_width_alpha 使用
+_FULLWIDTH_ALPHA_TO_ASCII = str.maketrans(
+    {chr(c): chr(c - 0xFEE0) for c in (*range(0xFF21, 0xFF3B), *range(0xFF41, 0xFF5B))}
+)
+
 # 1. 從 PDF 提取純文字 ----------------------------
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """從 PDF 提取所有純文字。"""
-    try:
-        doc = fitz.open(pdf_path)
-        text = ""
+def iter_pdf_page_texts(pdf_source: Union[str, fitz.Document]) -> Iterator[str]:
+    """
+    逐頁產生 PDF 純文字，一次只保留一頁的文字。
+    pdf_source 可以是路徑，或已開啟的 fitz.Document (由呼叫端負責關閉，這裡不會關)。
+    """
+    if isinstance(pdf_source, fitz.Document):
+        for page in pdf_source:
+            yield page.get_text()
+        return
+    with fitz.open(pdf_source) as doc:
         for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+            yield page.get_text()
+
+def extract_text_from_pdf(pdf_source: Union[str, fitz.Document]) -> str:
+    """從 PDF 提取所有純文字。pdf_source 可以是路徑或已開啟的 fitz.Document。"""
+    try:
+        # 一次 join，避免逐頁 += 重複複製整份字串
+        return "".join(iter_pdf_page_texts(pdf_source))
     except Exception as e:
-        print(f"Error extracting text from PDF {pdf_path}: {e}")
+        source_name = pdf_source.name if isinstance(pdf_source, fitz.Document) else pdf_source
+        print(f"Error extracting text from PDF {source_name}: {e}")
         return ""
 
 # 2. 從 PDF 首頁與檔名提取元數據 ----------------------------
@@ -70,42 +146,40 @@ def extract_metadata_from_text(pdf_text: str, filename: str) -> Dict[str, Any]:
         "period": None,
         "question_count": None,
     }
-    # 1. 先抓首頁前兩行非空行作為考試名稱
-    lines = [line.strip() for line in pdf_text.splitlines() if line.strip()]
-    if lines:
-        meta["exam_name"] = lines[0]
-    # 2. 代號
-    code_match = re.search(r"代[　\s]*號[：: ]*([0-9]+)", pdf_text)
-    if code_match:
-        meta["subject_code"] = code_match.group(1)
-    # 3. 類科名稱
-    type_match = re.search(r"類科名稱[：: ]*([\S ]+)", pdf_text)
-    if type_match:
-        meta["subject_type"] = type_match.group(1).strip()
-    # 4. 科目名稱
-    subject_match = re.search(r"科目名稱[：: ]*([\S ]+)", pdf_text)
-    if subject_match:
-        meta["subject_name"] = subject_match.group(1).strip()
+    # 1. 先抓首頁第一行非空行作為考試名稱
+    first_line = next((s for s in map(str.strip, pdf_text.splitlines()) if s), None)
+    if first_line:
+        meta["exam_name"] = first_line
+    # 2~6. 代號、類科名稱、科目名稱、年份期次、題數：單次掃描，每個欄位保留第一個 match，收齊即提早結束
+    found: Dict[str, re.Match] = {}
+    for m in _META_FIELDS_RE.finditer(pdf_text):
+        if m.lastgroup not in found:
+            found[m.lastgroup] = m
+            if len(found) == _META_FIELD_COUNT:
+                break
+    if "code" in found:
+        meta["subject_code"] = found["code"].group("code_val")
+    if "stype" in found:
+        meta["subject_type"] = found["stype"].group("stype_val").strip()
+    if "sname" in found:
+        meta["subject_name"] = found["sname"].group("sname_val").strip()
     # 5. 年份與期次
-    year_period_match = re.search(r"(\d{3,4})年[ _]*第?(\d+)次", pdf_text)
-    if year_period_match:
-        meta["year"] = int(year_period_match.group(1))
-        meta["period"] = int(year_period_match.group(2))
+    if "yp" in found:
+        meta["year"] = int(found["yp"].group("yp_year"))
+        meta["period"] = int(found["yp"].group("yp_period"))
     else:
         fn = filename
-        fn_match = re.search(r"(\d{3,4})年[_ ]*第?(\d+)次", fn)
+        fn_match = _FILENAME_YEAR_PERIOD_RE.search(fn)
         if fn_match:
             meta["year"] = int(fn_match.group(1))
             meta["period"] = int(fn_match.group(2))
         else:
-            fn_match2 = re.search(r"(\d{3,4})[ _-]?([1-4])", fn)
+            fn_match2 = _FILENAME_YEAR_PERIOD_SHORT_RE.search(fn)
             if fn_match2:
                 meta["year"] = int(fn_match2.group(1))
                 meta["period"] = int(fn_match2.group(2))
-    # 6. 題數
-    qcount_match = re.search(r"題[\s　]*數[：: ]*(\d+)", pdf_text)
-    if qcount_match:
-        meta["question_count"] = int(qcount_match.group(1))
+    if "qcount" in found:
+        meta["question_count"] = int(found["qcount"].group("qcount_val"))
     logger.info(f"Extracted metadata: {meta} (from {filename})")
     return meta
 
@@ -122,18 +196,34 @@ def _commit_buffer(
     field_name: str,
     option_key: Optional[str] = None
 ):
-    """Helper to join, strip, and commit buffered text to the target dictionary."""
-    text_to_commit = "\n".join(buffer).strip()
+    """
+    Helper to join and commit buffered text to the target dictionary.
+    Callers only append non-empty, already-stripped fragments, so the joined text needs no extra strip().
+    """
+    if not buffer:
+        return
+    text_to_commit = "\n".join(buffer)
     if text_to_commit: # Only commit if there's actual text
         if field_name == "options" and option_key:
-            if option_key not in target_dict["options"]: # Ensure option key exists
-                 target_dict["options"][option_key] = ""
             target_dict["options"][option_key] = text_to_commit
         elif field_name == "content":
             target_dict["content"] = text_to_commit
     buffer.clear()
 
-def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default") -> List[Dict[str, Any]]:
+@lru_cache(maxsize=8)
+def _compile_line_pattern(question_start_regex: str, option_regex: str) -> re.Pattern:
+    """
+    將題號與選項模式合併成單一 alternation，每行只需 match 一次。
+    題號分支在前，只有題號不成立時才會試選項分支，與原本「先題號、後選項」的判斷順序相同。
+    """
+    return re.compile(f"(?:{question_start_regex})|(?:{option_regex})")
+
+def parse_questions_from_pdf_text(
+    pdf_text: str,
+    parsing_mode: str = "default",
+    question_start_pattern: Optional[re.Pattern] = None,
+    option_pattern: Optional[re.Pattern] = None,
+) -> List[Dict[str, Any]]:
     """
     解析題號、題幹、選項，處理跨行、換頁等情況。
     返回題目列表，每題為 dict: {question_number, content, options}
@@ -143,6 +233,8 @@ def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default")
         parsing_mode: "default" or "strict_start".
                       "default": Allows question content to start with a digit (e.g., "52.70歲...").
                       "strict_start": Question content after "QN." cannot start with a digit (e.g., for "pKa = 6.8]").
+        question_start_pattern: Optional precompiled question-start pattern; looked up from parsing_mode if omitted.
+        option_pattern: Optional precompiled option pattern; defaults to _OPTION_RE.
     """
     questions_data: List[Dict[str, Any]] = []
     current_question: Dict[str, Any] = {}
@@ -150,49 +242,69 @@ def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default")
     active_option_letter: Optional[str] = None
     current_state: ParsingState = ParsingState.EXPECTING_QUESTION
 
-    # Compile patterns based on mode using module-level strings
+    # Patterns come precompiled from the caller, or from the module-level table for this mode
+    if question_start_pattern is None:
+        question_start_pattern = _QUESTION_START_PATTERNS.get(parsing_mode, _DEFAULT_QUESTION_START_RE)
     if parsing_mode == "strict_start":
-        question_start_pattern = re.compile(STRICT_QUESTION_START_REGEX_STR)
         logger.info("Using STRICT_START question pattern for text parsing.")
     else: # default mode
-        question_start_pattern = re.compile(DEFAULT_QUESTION_START_REGEX_STR)
         logger.info("Using DEFAULT question pattern for text parsing.")
     
-    option_pattern = re.compile(OPTION_REGEX_STR) # This is used for line-based matching in this func
+    if option_pattern is None:
+        option_pattern = _OPTION_RE # This is used for line-based matching in this func
+
+    # 每行只跑一次合併後的模式：題號分支的 group 在前，選項分支的 group 從 opt_group_base + 1 開始
+    line_pattern = _compile_line_pattern(question_start_pattern.pattern, option_pattern.pattern)
+    opt_group_base = question_start_pattern.groups
 
     lines = pdf_text.splitlines()
     # Ensure logger level is appropriate for these messages to appear
     # logger.setLevel(logging.DEBUG) # Consider setting this at a higher level if needed for testing
+    # 迴圈前只判斷一次日誌等級：逐行診斷只在 DEBUG 輸出，選項日誌只在 INFO 輸出，關閉時訊息都不必組出來
+    log_info = logger.isEnabledFor(logging.INFO)
+    diag_line_limit = 30 if logger.isEnabledFor(logging.DEBUG) else 0
+    # 狀態比較在每行都會發生，先綁成區域變數省去 enum 屬性查找
+    STATE_QUESTION_CONTENT = ParsingState.PARSING_QUESTION_CONTENT
+    STATE_OPTION_TEXT = ParsingState.PARSING_OPTION_TEXT
+    # 迴圈內每行都會用到的方法先綁成區域變數 (buffer 只 clear()、不重新指派，綁定一直有效)
+    match_line = line_pattern.match
+    buffer_append = current_text_buffer.append
+    append_question = questions_data.append
 
     for line_idx, line_raw in enumerate(lines):
         # Diagnostic logging for the first ~20 lines and any lines near where a question *should* be found
-        if line_idx < 20 or (current_question and line_idx < 30): # Log more initial lines
-            logger.info(f"PDFParse Line {line_idx + 1}/{len(lines)}: '{line_raw[:150]}'") # Log more chars
-            logger.info(f"PDFParse Repr {line_idx + 1}: {repr(line_raw[:150])}")
-
-        q_match = question_start_pattern.match(line_raw)
-        opt_match = option_pattern.match(line_raw)
+        if line_idx < diag_line_limit and (line_idx < 20 or current_question): # Log more initial lines
+            logger.debug("PDFParse Line %d: '%s'", line_idx + 1, line_raw[:150]) # Log more chars
+            logger.debug("PDFParse Repr %d: %r", line_idx + 1, line_raw[:150])
+
+        line_match = match_line(line_raw)
+        # 選項分支的 group 一定會參與 match，所以 lastindex 超過題號分支的 group 數即代表選項
+        if line_match and line_match.lastindex is not None and line_match.lastindex > opt_group_base:
+            q_match, opt_match = None, line_match
+        else:
+            q_match, opt_match = line_match, None
 
-        if line_idx < 20 or (current_question and line_idx < 30):
-            logger.info(f"  Attempting match on: {repr(line_raw)}")
-            logger.info(f"  Q_match: {bool(q_match)} (Pattern: {question_start_pattern.pattern})")
+        if line_idx < diag_line_limit and (line_idx < 20 or current_question):
+            logger.debug("  Attempting match on: %r", line_raw)
+            logger.debug("  Q_match: %s (Pattern: %s)", bool(q_match), question_start_pattern.pattern)
             if q_match:
-                logger.info(f"    Q_match groups: {q_match.groups()}")
-            logger.info(f"  Opt_match: {bool(opt_match)} (Pattern: {option_pattern.pattern})")
+                logger.debug("    Q_match groups: %s", q_match.groups()[:opt_group_base])
+            logger.debug("  Opt_match: %s (Pattern: %s)", bool(opt_match), option_pattern.pattern)
             if opt_match:
-                logger.info(f"    Opt_match groups: {opt_match.groups()}")
+                logger.debug("    Opt_match groups: %s", opt_match.groups()[opt_group_base:])
 
         if q_match: # New question starts
-            logger.info(f"Line {line_idx + 1} matched QUESTION start: '{line_raw}'") # Changed to INFO for visibility
+            if log_info:
+                logger.info(f"Line {line_idx + 1} matched QUESTION start: '{line_raw}'") # Changed to INFO for visibility
             # Finalize previous question if any
             if current_question:
-                if current_state == ParsingState.PARSING_OPTION_TEXT and active_option_letter:
+                if current_state == STATE_OPTION_TEXT and active_option_letter:
                     _commit_buffer(current_text_buffer, current_question, "options", active_option_letter)
-                elif current_state == ParsingState.PARSING_QUESTION_CONTENT:
+                elif current_state == STATE_QUESTION_CONTENT:
                     _commit_buffer(current_text_buffer, current_question, "content")
                 
                 if current_question.get("question_number"): # Ensure it's a valid question
-                    questions_data.append(current_question)
+                    append_question(current_question)
 
             # Initialize new question
             current_text_buffer.clear()
@@ -201,42 +313,39 @@ def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default")
             current_question = {"question_number": question_number, "content": "", "options": {}}
             
             if initial_content_part:
-                current_text_buffer.append(initial_content_part)
+                buffer_append(initial_content_part)
             
-            current_state = ParsingState.PARSING_QUESTION_CONTENT
+            current_state = STATE_QUESTION_CONTENT
             active_option_letter = None
 
         elif opt_match and current_question: # New option starts for the current question
-            logger.info(f"Line {line_idx + 1} matched OPTION start: '{line_raw}' for Q#{current_question.get('question_number')}") # Changed to INFO
-            if current_state == ParsingState.PARSING_QUESTION_CONTENT:
+            if log_info:
+                logger.info(f"Line {line_idx + 1} matched OPTION start: '{line_raw}' for Q#{current_question.get('question_number')}") # Changed to INFO
+            if current_state == STATE_QUESTION_CONTENT:
                 _commit_buffer(current_text_buffer, current_question, "content")
-            elif current_state == ParsingState.PARSING_OPTION_TEXT and active_option_letter:
+            elif current_state == STATE_OPTION_TEXT and active_option_letter:
                 _commit_buffer(current_text_buffer, current_question, "options", active_option_letter)
             
             current_text_buffer.clear()
             
-            option_letter_raw = opt_match.group(1) or opt_match.group(2)
-            normalized_letter = option_letter_raw
-            if '\uFF21' <= option_letter_raw <= '\uFF3A': # Full-width A-Z
-                normalized_letter = chr(ord(option_letter_raw) - (ord('\uFF21') - ord('A')))
-            active_option_letter = normalized_letter
+            option_letter_raw = opt_match.group(opt_group_base + 1) or opt_match.group(opt_group_base + 2)
+            active_option_letter = option_letter_raw.translate(_FULLWIDTH_TO_ASCII)
             
-            option_text_part = opt_match.group(3).strip()
+            option_text_part = opt_match.group(opt_group_base + 3).strip()
             if option_text_part:
-                current_text_buffer.append(option_text_part)
-            # Ensure option key exists, _commit_buffer will fill it later if text_buffer is not empty
-            if active_option_letter and active_option_letter not in current_question["options"]:
-                 current_question["options"][active_option_letter] = ""
+                buffer_append(option_text_part)
+            # Ensure option key exists (選項本身沒有文字時保留為 "")，_commit_buffer will fill it later if text_buffer is not empty
+            current_question["options"].setdefault(active_option_letter, "")
 
-            current_state = ParsingState.PARSING_OPTION_TEXT
+            current_state = STATE_OPTION_TEXT
 
         elif current_question: # Continuation of current question content or option text
             line_stripped = line_raw.strip()
             if line_stripped: # Only append non-empty lines
                 # logger.debug(f"Line {line_idx + 1} is continuation: '{line_stripped}' for state {current_state}")
-                if current_state == ParsingState.PARSING_QUESTION_CONTENT or \
-                   current_state == ParsingState.PARSING_OPTION_TEXT:
-                    current_text_buffer.append(line_stripped)
+                if current_state == STATE_QUESTION_CONTENT or \
+                   current_state == STATE_OPTION_TEXT:
+                    buffer_append(line_stripped)
         else:
             # This line is not part of any question (e.g. header/footer, or before first question)
             # logger.debug(f"Line {line_idx + 1} skipped (no active question or not matched): '{line_raw}'")
@@ -244,9 +353,9 @@ def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default")
 
     # Finalize the last question being processed
     if current_question:
-        if current_state == ParsingState.PARSING_OPTION_TEXT and active_option_letter:
+        if current_state == STATE_OPTION_TEXT and active_option_letter:
             _commit_buffer(current_text_buffer, current_question, "options", active_option_letter)
-        elif current_state == ParsingState.PARSING_QUESTION_CONTENT:
+        elif current_state == STATE_QUESTION_CONTENT:
             _commit_buffer(current_text_buffer, current_question, "content")
         
         if current_question.get("question_number"): # Ensure it's a valid question
@@ -283,6 +392,41 @@ def parse_questions_from_pdf_text(pdf_text: str, parsing_mode: str = "default")
 
 # 4. 解析答案卷 ----------------------------
 
+def _scan_note_matches(note_text: str) -> List[List[re.Match]]:
+    """
+    單次掃描備註文字，在每個「第N」位置嘗試所有 _NOTE_PATTERNS。
+    回傳與 _NOTE_PATTERNS 對應的 match 列表，結果等同於對每個模式各跑一次 finditer。
+    """
+    matches: List[List[re.Match]] = [[] for _ in _NOTE_PATTERNS]
+    resume_at = [0] * len(_NOTE_PATTERNS) # 各模式上一個 match 的結尾 (finditer 不重疊)
+    for anchor in _NOTE_ANCHOR_RE.finditer(note_text):
+        pos = anchor.start()
+        for k, pattern in enumerate(_NOTE_PATTERNS):
+            if pos < resume_at[k]:
+                continue
+            m = pattern.match(note_text, pos)
+            if m:
+                matches[k].append(m)
+                resume_at[k] = m.end()
+    return matches
+
+def _nearest_x_index(sorted_xs: List[float], sorted_order: List[int], x: float) -> Tuple[Optional[int], float]:
+    """
+    在依 (x, 原索引) 排序的座標中二分搜尋最接近 x 的項目，回傳 (原索引, 距離)。
+    距離相同時取原索引較小者，與依原順序線性掃描、以嚴格 < 比較的結果相同。
+    """
+    pos = bisect_left(sorted_xs, x)
+    best_idx: Optional[int] = None
+    best_dist = math.inf
+    if pos < len(sorted_xs): # 右側 (>= x) 最近的一群中，pos 即為原索引最小者
+        best_idx, best_dist = sorted_order[pos], sorted_xs[pos] - x
+    if pos > 0: # 左側 (< x) 最近的值可能重複，取同值一群的第一個
+        left_pos = bisect_left(sorted_xs, sorted_xs[pos - 1])
+        left_dist = x - sorted_xs[left_pos]
+        if left_dist < best_dist or (left_dist == best_dist and sorted_order[left_pos] < best_idx):
+            best_idx, best_dist = sorted_order[left_pos], left_dist
+    return best_idx, best_dist
+
 def parse_answers_from_pdf_text(answer_pdf_path: str) -> Dict[int, Any]:
     """
     解析答案表格，返回題號到答案的映射。
@@ -298,159 +442,161 @@ def parse_answers_from_pdf_text(answer_pdf_path: str) -> Dict[int, Any]:
     try:
         with fitz.open(answer_pdf_path) as doc:
             for page_num, page in enumerate(doc):
-                raw_text_for_notes_pages.append(page.get_text("text"))
+                # 建立一次 TextPage，"text" 與 "words" 共用，避免重複解析頁面內容流
+                textpage = page.get_textpage(flags=fitz.TEXTFLAGS_WORDS)
+                raw_text_for_notes_pages.append(page.get_text("text", textpage=textpage))
                 
-                words = page.get_text("words")
+                words = page.get_text("words", textpage=textpage)
+                textpage = None
                 if not words:
                     continue
 
-                words.sort(key=lambda w: (w[1], w[0]))
+                # 將 word tuple (x0, y0, x1, y1, text, ...) 拆成平行列表 (SoA)，
+                # 依 (y0, x0) 排序一次後，之後都以索引存取 (itemgetter 在 C 層取 key，免去 lambda 呼叫)
+                words = sorted(words, key=itemgetter(1, 0))
+                w_x0 = [w[0] for w in words]
+                w_y0 = [w[1] for w in words]
+                w_text = [w[4] for w in words]
+                w_x_mid = [(w[0] + w[2]) / 2 for w in words]
 
                 structured_lines = []
-                if words:
-                    current_line_buffer = []
-                    Y_GROUPING_TOLERANCE = 5
-
-                    for word_idx, word_info in enumerate(words):
-                        if not current_line_buffer:
-                            current_line_buffer.append(word_info)
-                        else:
-                            first_word_y0_in_current_line = current_line_buffer[0][1]
-                            y_diff = abs(word_info[1] - first_word_y0_in_current_line)
-                            is_grouping = y_diff < Y_GROUPING_TOLERANCE
-                            
-                            if is_grouping:
-                                current_line_buffer.append(word_info)
-                            else:
-                                current_line_buffer.sort(key=lambda w: w[0])
-                                structured_lines.append({
-                                    "y0": current_line_buffer[0][1],
-                                    "words": list(current_line_buffer),
-                                    "text": " ".join(w[4] for w in current_line_buffer)
-                                })
-                                current_line_buffer = [word_info]
-                    
-                    if current_line_buffer:
-                        current_line_buffer.sort(key=lambda w: w[0])
-                        structured_lines.append({
-                            "y0": current_line_buffer[0][1],
-                            "words": list(current_line_buffer),
-                            "text": " ".join(w[4] for w in current_line_buffer)
-                        })
-                
+                Y_GROUPING_TOLERANCE = 5
+                word_count = len(w_text)
+
+                # w_y0 已排序：每行從錨點字 (本行最小 y0) 開始，直到第一個 y0 - 錨點 >= 容差的字為止。
+                # 以二分搜尋找出分行位置，再前後微調以吸收 anchor + 容差 的浮點誤差，結果與逐字比較相同
+                line_start = 0
+                while line_start < word_count:
+                    line_anchor_y0 = w_y0[line_start] # 本行最小的 y0；逐行非遞減
+                    line_end = bisect_left(w_y0, line_anchor_y0 + Y_GROUPING_TOLERANCE, line_start + 1)
+                    while line_end > line_start + 1 and w_y0[line_end - 1] - line_anchor_y0 >= Y_GROUPING_TOLERANCE:
+                        line_end -= 1
+                    while line_end < word_count and w_y0[line_end] - line_anchor_y0 < Y_GROUPING_TOLERANCE:
+                        line_end += 1
+                    line_word_idx = sorted(range(line_start, line_end), key=w_x0.__getitem__)
+                    structured_lines.append({
+                        "y0": w_y0[line_word_idx[0]],
+                        "anchor_y0": line_anchor_y0,
+                        "idx": line_word_idx,
+                        "text": " ".join(w_text[k] for k in line_word_idx)
+                    })
+                    line_start = line_end
+
                 q_num_rows_data = []
                 ans_rows_data = []
 
                 for i, line_obj in enumerate(structured_lines):
                     line_text_concat = line_obj["text"]
-                    
+
                     if ("題號" in line_text_concat or "序" in line_text_concat) and any(char.isdigit() for char in line_text_concat):
-                        current_q_numbers = []
-                        for word_info in line_obj["words"]:
-                            if word_info[4].isdigit():
-                                current_q_numbers.append({'text': word_info[4], 'x_mid': (word_info[0] + word_info[2]) / 2, 'y0': word_info[1]})
-                        if current_q_numbers:
-                            q_num_rows_data.append({'index': i, 'q_numbers': current_q_numbers, 'y0': line_obj["y0"]})
-
-                    elif "答案" in line_text_concat and (re.search(r"[A-Z\uFF21-\uFF3A#\uFF03]", line_text_concat)):
-                        current_answers = []
-                        for word_info in line_obj['words']:
-                            word_text_original = word_info[4]
-                            word_text_stripped = word_text_original.strip()
+                        q_word_idx = [k for k in line_obj["idx"] if w_text[k].isdigit()]
+                        if q_word_idx:
+                            q_num_rows_data.append({'index': i, 'q_idx': q_word_idx, 'y0': line_obj["y0"]})
+
+                    elif "答案" in line_text_concat and (_ANSWER_CHAR_RE.search(line_text_concat)):
+                        ans_texts = []
+                        ans_x_mids = []
+                        for k in line_obj['idx']:
+                            word_text_stripped = w_text[k].strip()
                             ans_char_to_add = None
 
-                            if re.fullmatch(r"^[A-Z\uFF21-\uFF3A#\uFF03]$", word_text_stripped):
+                            if word_text_stripped in _ANSWER_CHARS: # 集合內皆為單一字元，等同 fullmatch
                                 ans_char_to_add = word_text_stripped
-                            elif word_text_stripped.startswith("答案") and len(word_text_stripped) == 3:
+                            elif len(word_text_stripped) == 3 and word_text_stripped.startswith("答案"):
                                 potential_ans_char = word_text_stripped[2]
-                                if re.fullmatch(r"^[A-Z\uFF21-\uFF3A#\uFF03]$", potential_ans_char):
+                                if potential_ans_char in _ANSWER_CHARS:
                                     ans_char_to_add = potential_ans_char
-                            
+
                             if ans_char_to_add:
-                                normalized_ans_char = normalize_full_width_alpha(ans_char_to_add)
-                                current_answers.append({
-                                    'text': normalized_ans_char, # 使用標準化後的字符
-                                    'x_mid': (word_info[0] + word_info[2]) / 2,
-                                    'y0': word_info[1]
-                                })
-                            elif word_text_stripped == "答案":
-                                pass 
-
-                        if current_answers:
-                           ans_rows_data.append({'index': i, 'answers': current_answers, 'y0': line_obj["y0"]})
-                
+                                ans_texts.append(normalize_full_width_alpha(ans_char_to_add)) # 使用標準化後的字符
+                                ans_x_mids.append(w_x_mid[k])
+
+                        if ans_texts:
+                           # 依 (x_mid, 原順序) 排序一次，供每個題號二分搜尋最近的答案
+                           ans_order = sorted(range(len(ans_x_mids)), key=ans_x_mids.__getitem__)
+                           ans_rows_data.append({
+                               'index': i, 'ans_texts': ans_texts, 'ans_x_mids': ans_x_mids,
+                               'y0': line_obj["y0"], 'anchor_y0': line_obj["anchor_y0"],
+                               'ans_order': ans_order, 'ans_sorted_x': [ans_x_mids[j] for j in ans_order],
+                           })
+
                 processed_ans_row_indices = set()
+                ans_row_line_indices = [a_row_data['index'] for a_row_data in ans_rows_data] # 遞增
 
                 for q_row_data in q_num_rows_data:
                     best_candidate_ans_row = None
-                    min_y_diff = float('inf')
+                    min_y_diff = 40 # 以距離上限當初始值：只接受 0 < y_diff < 40 且更近的答案列
 
-                    for a_row_data in ans_rows_data:
-                        if a_row_data['index'] > q_row_data['index'] and a_row_data['index'] not in processed_ans_row_indices:
+                    # 只看題號列之後的答案列；各行 anchor_y0 非遞減且 y0 >= anchor_y0，
+                    # 一旦 anchor_y0 與題號列的差距已不小於目前最佳值，後面的列都不可能更近
+                    for a_pos in range(bisect_right(ans_row_line_indices, q_row_data['index']), len(ans_rows_data)):
+                        a_row_data = ans_rows_data[a_pos]
+                        if a_row_data['anchor_y0'] - q_row_data['y0'] >= min_y_diff:
+                            break
+                        if a_row_data['index'] not in processed_ans_row_indices:
                             y_diff = a_row_data['y0'] - q_row_data['y0']
-                            if 0 < y_diff < 40: 
-                               if y_diff < min_y_diff:
-                                   min_y_diff = y_diff
-                                   best_candidate_ans_row = a_row_data
+                            if 0 < y_diff < min_y_diff:
+                               min_y_diff = y_diff
+                               best_candidate_ans_row = a_row_data
                     
                     if best_candidate_ans_row:
                         processed_ans_row_indices.add(best_candidate_ans_row['index'])
-                        
-                        for q_idx, q_tuple in enumerate(q_row_data['q_numbers']):
-                            q_text = q_tuple['text']
-                            q_x = q_tuple['x_mid']
-                            
-                            best_ans_for_q = None
-                            min_x_dist_for_q = float('inf')
+                        ans_texts = best_candidate_ans_row['ans_texts']
 
-                            for ans_idx, ans_tuple in enumerate(best_candidate_ans_row['answers']):
-                                ans_text = ans_tuple['text']
-                                ans_x = ans_tuple['x_mid']
-                                x_dist = abs(q_x - ans_x)
+                        for k in q_row_data['q_idx']:
+                            q_text = w_text[k]
+                            q_x = w_x_mid[k]
 
-                                if x_dist < min_x_dist_for_q and x_dist < 25:
-                                    min_x_dist_for_q = x_dist
-                                    best_ans_for_q = ans_text
+                            best_ans_for_q = None
+                            # 只接受 x_dist < 25 的最近答案
+                            ans_idx, x_dist = _nearest_x_index(best_candidate_ans_row['ans_sorted_x'], best_candidate_ans_row['ans_order'], q_x)
+                            if ans_idx is not None and x_dist < 25:
+                                best_ans_for_q = ans_texts[ans_idx]
                             
                             q_num_int = int(q_text)
                             if best_ans_for_q:
                                 answers[q_num_int] = [best_ans_for_q]
                             else:
                                 answers[q_num_int] = ['#']
-                                logger.warning(f"Page {page_num+1}, Q {q_text} (x={q_x:.1f}, y={q_tuple['y0']:.1f}): No aligned answer found in ans_row (y={best_candidate_ans_row['y0']:.1f}). Setting to '#'.")
+                                logger.warning(f"Page {page_num+1}, Q {q_text} (x={q_x:.1f}, y={w_y0[k]:.1f}): No aligned answer found in ans_row (y={best_candidate_ans_row['y0']:.1f}). Setting to '#'.")
     except Exception as e:
         logger.error(f"Error parsing answers from {answer_pdf_path}: {e}")
         if notes:
              return {"answers": answers, "notes": notes}
         return answers
 
-    full_raw_text_for_notes = "\n".join(raw_text_for_notes_pages)
-    note_lines = [line.strip() for line in full_raw_text_for_notes.splitlines() if line.strip()]
+    # 逐頁切行後直接串接 (空行本來就會被濾掉，不必先 join 成整份文字)，每行只 strip 一次
+    note_lines = [
+        line for line in map(str.strip, chain.from_iterable(page_text.splitlines() for page_text in raw_text_for_notes_pages))
+        if line
+    ]
     for j, line in enumerate(note_lines):
-        if re.match(r"^\s*備\s*註", line): 
+        # 「備註」標題 (備、註之間可有空白)；note_lines 已 strip，直接比對開頭字元，不必跑 regex
+        if line.startswith("備") and line[1:].lstrip().startswith("註"):
             note_text = "\n".join(note_lines[j:]) 
-            for m in re.finditer(r"第(\d+)題[，,，、及和與]*(?:答案|選項)?(?:更正為|應為)?([A-D#\uFF03])(?:.*?)。", note_text):
+            correct_matches, bonus_matches, generic_matches, multi_matches = _scan_note_matches(note_text)
+
+            for m in correct_matches:
                 qn = int(m.group(1))
                 corrected_ans = m.group(2)
                 normalized_corrected_ans = normalize_full_width_alpha(corrected_ans)
                 notes[qn] = f"答案更正為 {normalized_corrected_ans}" # 也可以在筆記中用標準化字符
                 answers[qn] = [normalized_corrected_ans] # 使用標準化後的答案
 
-            for m in re.finditer(r"第(\d+)題[，,，]?(送分|均給分|皆給分|給分)", note_text):
+            for m in bonus_matches:
                 qn = int(m.group(1))
                 notes[qn] = "送分"
                 answers[qn] = ['送分'] 
 
-            for m in re.finditer(r"第(\d+)題[，,，]?(?!送分|均給分|皆給分|給分|答案更正為|選項更正為|應為)([^第].*?)。", note_text):
+            for m in generic_matches:
                 qn = int(m.group(1))
                 note_content = m.group(2).strip() 
                 if qn not in notes:
                   notes[qn] = note_content
             
-            multi_q_note_pattern = r"第(\d+(?:[、,及和與]\d+)*)題(?:(?:等)|(?:各題))?[，,，]?(送分|均給分|皆給分|給分|(?:答案|選項)?(?:更正為|應為)?([A-D#\uFF03]))(?:.*?)。"
-            for m in re.finditer(multi_q_note_pattern, note_text):
+            for m in multi_matches:
                 q_numbers_str = m.group(1)
-                q_nums = [int(qn_str) for qn_str in re.findall(r"\d+", q_numbers_str)]
+                q_nums = [int(qn_str) for qn_str in _DIGITS_RE.findall(q_numbers_str)]
                 
                 note_type = m.group(2) 
                 corrected_ans_val = m.group(3)
@@ -481,11 +627,13 @@ def parse_answers_from_pdf_text(answer_pdf_path: str) -> Dict[int, Any]:
 def combine_questions_and_answers(
     questions: List[Dict[str, Any]],
     answers_map: Dict[int, List[str]],
-    notes_map: Optional[Dict[int, str]] = None
+    notes_map: Optional[Dict[int, str]] = None,
+    copy: bool = False
 ) -> List[Dict[str, Any]]:
     """
     將題目與答案合併，補齊 correct_answer_key、notes 等欄位。
     若遇到特殊情況，notes 標註。
+    注意：預設 (copy=False) 直接修改傳入的題目 dict，不另建副本；呼叫端之後仍需使用原 dict 時請傳 copy=True。
     """
     combined_data = []
     if notes_map is None:
@@ -499,7 +647,7 @@ def combine_questions_and_answers(
             continue
 
         # Initialize fields to ensure they exist, even if no data is found
-        question_copy = question.copy() # Work on a copy
+        question_copy = question.copy() if copy else question
         question_copy["correct_answer_key"] = []
         question_copy["notes"] = None
 
@@ -527,17 +675,54 @@ def combine_questions_and_answers(
 
 # 6. 存 processed_data ----------------------------
 
-def save_processed_data(data: Dict[str, Any], out_path: str):
-    """保存處理後的數據到 JSON 文件。"""
+def _write_json_atomic(data: Any, out_path: Union[str, Path], indent: Optional[int] = None):
+    """先寫入暫存檔再以 os.replace 取代 out_path，中途失敗不會留下寫一半的 JSON。錯誤照常拋出，由呼叫端記錄。"""
+    tmp_path = f"{out_path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        # 清掉未完成的暫存檔
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_processed_data(data: Dict[str, Any], out_path: str) -> bool:
+    """保存處理後的數據到 JSON 文件 (原子寫入)。成功時返回 True。"""
     try:
         os.makedirs(os.path.dirname(out_path), exist_ok=True)  # Create directory if it doesn't exist
-        with open(out_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        _write_json_atomic(data, out_path, indent=4)
         logger.info(f"Processed data saved to: {out_path}")
+        return True
     except IOError as e:
         logger.error(f"Error saving processed data to {out_path}: {e}")
     except Exception as e:
         logger.error(f"An unexpected error occurred while saving processed data to {out_path}: {e}")
+    return False
+
+def load_up_to_date_processed_data(out_path: Path, source_key: str) -> Optional[Dict[str, Any]]:
+    """
+    上次寫入 out_path 時記錄的來源鍵與 source_key 相同 (同一組題目卷、答案卷內容與解析邏輯)，
+    且引用的圖片都還在時，直接讀回上次的結果；否則返回 None，由呼叫端重新解析。
+    """
+    # 不同考試的元數據可能對應到同一個輸出路徑，只看修改時間會誤用別份考試的結果，因此比對來源鍵
+    if _load_cache_key(get_processed_source_path(out_path)) != source_key:
+        return None
+    try:
+        with open(out_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None # 輸出不存在或 JSON 損壞：重新解析
+    if not isinstance(data, dict) or "meta" not in data or "questions" not in data:
+        return None
+    missing_image = _find_missing_image(data["questions"])
+    if missing_image is not None:
+        logger.info(f"Image {missing_image} referenced by {out_path} is missing; re-parsing.")
+        return None
+    return data
 
 def save_raw_text(text_content: str, out_path: str):
     """保存提取的純文字到文件。"""
@@ -551,22 +736,37 @@ def save_raw_text(text_content: str, out_path: str):
     except Exception as e:
         logger.error(f"An unexpected error occurred while saving raw text to {out_path}: {e}")
 
+def save_image_bytes(image_bytes: bytes, out_path: Path):
+    """保存已編碼的圖片位元組 (如 PNG) 到文件。可在背景執行緒中呼叫。"""
+    try:
+        with open(out_path, 'wb') as f:
+            f.write(image_bytes)
+        logger.debug(f"Image saved to: {out_path}")
+    except IOError as e:
+        logger.error(f"Error saving image to {out_path}: {e}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while saving image to {out_path}: {e}")
+
 # 7. 主流程範例 ----------------------------
 
+# 題目解析模式規則：(路徑中須同時包含的子字串, 解析模式)，依序比對，第一個符合者生效
+# 您可以根據實際情況擴展這些規則，例如檢查路徑中是否包含特定的科目名稱或年份組合
+PARSING_MODE_RULES: Tuple[Tuple[Tuple[str, ...], str], ...] = (
+    (("臨床鏡檢學與分子生物學", "111年_第一次", "題目1111鏡檢.pdf"), "strict_start"),
+    # Add more rules here if needed for other specific PDFs
+    # (("some_other_keyword", "another_condition"), "strict_start"),
+)
+
+@lru_cache(maxsize=256)
 def determine_parsing_mode(pdf_path: str) -> str:
-    """根據文件名/路徑決定題目解析模式"""
+    """根據文件名/路徑決定題目解析模式 (結果按路徑快取)"""
     # 默認為 'default' 模式
     mode = "default"
-    
-    # 示例規則：
-    # 您可以根據實際情況擴展這些規則。
-    # 例如，檢查路徑中是否包含特定的科目名稱或年份組合
-    if "臨床鏡檢學與分子生物學" in pdf_path and "111年_第一次" in pdf_path and "題目1111鏡檢.pdf" in pdf_path:
-        mode = "strict_start"
-    # Add more rules here if needed for other specific PDFs
-    # elif "some_other_keyword" in pdf_path and "another_condition" in pdf_path:
-    #     mode = "strict_start"
-        
+    for required_substrings, rule_mode in PARSING_MODE_RULES:
+        if all(substring in pdf_path for substring in required_substrings):
+            mode = rule_mode
+            break
+
     logger.info(f"Determined parsing_mode='{mode}' for {pdf_path}")
     return mode
 
@@ -580,50 +780,70 @@ def process_exam_pdfs(question_pdf_path: str, answer_pdf_path: str, processed_pr
     5. 存 processed_data (只存 parsed JSON)
     """
     # 1. 讀取 PDF (題目卷文字用於元數據提取)
-    full_question_text = extract_text_from_pdf(question_pdf_path)
-    # 答案卷的文字提取會在 parse_answers_from_pdf_text 內部處理
-
-    # 2. 提取元數據（使用完整的題目卷文本）
-    meta = extract_metadata_from_text(full_question_text, os.path.basename(question_pdf_path))
-    logger.info(f"Extracted metadata: {meta} (from {os.path.basename(question_pdf_path)})")
-
-    # --- Construct output paths based on metadata ---
-    subject_name_sanitized = sanitize_for_filesystem(meta.get('subject_name', 'UnknownSubject'))
-    year_str = str(meta.get('year', 'UnknownYear'))
-    period_str = str(meta.get('period', 'UnknownPeriod'))
-    # exam_name_sanitized = sanitize_for_filesystem(meta.get('exam_name', 'UnknownExamName')) # No longer used for dir or file name directly
-
-    # --- Create Subject Abbreviation ---
-    subject_name_original = meta.get('subject_name')
-    subject_short_name = "未知簡稱" # Default
-    if subject_name_original:
-        if "與" in subject_name_original:
-            subject_short_name = subject_name_original.split("與")[0]
-        elif "和" in subject_name_original:
-            subject_short_name = subject_name_original.split("和")[0]
-        elif "及" in subject_name_original: # Adding "及" based on "臨床血液學及血庫學" from schema examples
-            subject_short_name = subject_name_original.split("及")[0]
-        else:
-            # Fallback: take first 2 chars if no common separator, common for abbreviations like 生化, 血液
-            subject_short_name = subject_name_original[:2] 
-    subject_short_name_sanitized = sanitize_for_filesystem(subject_short_name)
+    # 題目卷只開一次，元數據與逐頁題目解析共用同一個 Document，不必重複解析 xref
+    try:
+        question_doc: Optional[fitz.Document] = fitz.open(question_pdf_path)
+    except Exception as e:
+        logger.error(f"Error opening question PDF {question_pdf_path}: {e}")
+        question_doc = None
+    # 後續任何一步出錯或提早返回，都在 finally 關閉題目卷
+    try:
+        full_question_text = extract_text_from_pdf(question_doc if question_doc is not None else question_pdf_path)
+        # 答案卷的文字提取會在 parse_answers_from_pdf_text 內部處理
+
+        # 2. 提取元數據（使用完整的題目卷文本）
+        meta = extract_metadata_from_text(full_question_text, os.path.basename(question_pdf_path))
+        logger.info(f"Extracted metadata: {meta} (from {os.path.basename(question_pdf_path)})")
+
+        # --- Construct output paths based on metadata ---
+        subject_name_sanitized = sanitize_for_filesystem(meta.get('subject_name', 'UnknownSubject'))
+        year_str = str(meta.get('year', 'UnknownYear'))
+        period_str = str(meta.get('period', 'UnknownPeriod'))
+        # exam_name_sanitized = sanitize_for_filesystem(meta.get('exam_name', 'UnknownExamName')) # No longer used for dir or file name directly
+
+        # --- Create Subject Abbreviation ---
+        subject_name_original = meta.get('subject_name')
+        subject_short_name = "未知簡稱" # Default
+        if subject_name_original:
+            # 依優先順序找分隔字 ("及" based on "臨床血液學及血庫學" from schema examples)；
+            # partition 一次掃描即取得分隔字前的部分，不必先 in 再 split 成列表
+            for sep in _SUBJECT_NAME_SEPARATORS:
+                head, found_sep, _ = subject_name_original.partition(sep)
+                if found_sep:
+                    subject_short_name = head
+                    break
+            else:
+                # Fallback: take first 2 chars if no common separator, common for abbreviations like 生化, 血液
+                subject_short_name = subject_name_original[:2]
+        subject_short_name_sanitized = sanitize_for_filesystem(subject_short_name)
     
-    year_period_folder = f"{year_str}_{period_str}"
+        year_period_folder = f"{year_str}_{period_str}"
 
-    # Base directory for this specific exam's parsed files
-    # Format: parsed/科目全名/年份_期次/
-    parsed_exam_dir = PROCESSED_DATA_DIR / "parsed" / subject_name_sanitized / year_period_folder
+        # Base directory for this specific exam's parsed files
+        # Format: parsed/科目全名/年份_期次/
+        parsed_exam_dir = PROCESSED_DATA_DIR / "parsed" / subject_name_sanitized / year_period_folder
     
-    # Full file path for the parsed JSON
-    # Format: parsed/科目全名/年份_期次/[年份][期次][科目簡稱].json
-    output_filename = f"{year_str}{period_str}{subject_short_name_sanitized}.json"
-    output_parsed_filepath = parsed_exam_dir / output_filename
-    # --- End of output path construction ---
-
-    # 3. 解析題目（包含圖片）與答案
-    #   3a. 解析題目卷 (這會處理圖片提取並返回包含 image_path 的題目列表)
-    logger.info(f"Starting to parse questions and images from: {question_pdf_path}")
-    questions = parse_questions_from_pdf(pdf_path=question_pdf_path) # This now includes image paths
+        # Full file path for the parsed JSON
+        # Format: parsed/科目全名/年份_期次/[年份][期次][科目簡稱].json
+        output_filename = f"{year_str}{period_str}{subject_short_name_sanitized}.json"
+        output_parsed_filepath = parsed_exam_dir / output_filename
+        # --- End of output path construction ---
+
+        # 上次寫入此輸出的正是同一組 PDF 內容時，直接沿用已存的 parsed JSON，不再解析題目、圖片與答案
+        source_key = get_processed_source_key(question_pdf_path, answer_pdf_path)
+        if source_key is not None:
+            up_to_date_data = load_up_to_date_processed_data(output_parsed_filepath, source_key)
+            if up_to_date_data is not None:
+                logger.info(f"Parsed output {output_parsed_filepath} was produced from the same PDFs; reusing it.")
+                return up_to_date_data, str(output_parsed_filepath)
+
+        # 3. 解析題目（包含圖片）與答案
+        #   3a. 解析題目卷 (這會處理圖片提取並返回包含 image_path 的題目列表)
+        logger.info(f"Starting to parse questions and images from: {question_pdf_path}")
+        questions = parse_questions_from_pdf(pdf_path=question_pdf_path, doc=question_doc) # This now includes image paths
+    finally:
+        if question_doc is not None:
+            question_doc.close()
     logger.info(f"Parsed {len(questions)} question structures (including image references) from {question_pdf_path}.")
 
     #   3b. 解析答案卷
@@ -646,7 +866,9 @@ def process_exam_pdfs(question_pdf_path: str, answer_pdf_path: str, processed_pr
             final_notes_map = None
     elif isinstance(raw_answers_output, dict):
         # Check if it's a direct Dict[int, List[str]] answers map
-        if all(isinstance(k, int) and isinstance(v, list) for k, v in raw_answers_output.items()):
+        # 答案表由 parse_answers_from_pdf_text 產生，鍵值型別一致，只看第一筆即可判斷 (空 dict 視為合法)
+        sample_key, sample_value = next(iter(raw_answers_output.items()), (0, []))
+        if isinstance(sample_key, int) and isinstance(sample_value, list):
             final_answers_map = raw_answers_output
         else:
             logger.warning(f"Received a dict from parse_answers_from_pdf_text that is not a direct answer map (Dict[int, List[str]]) nor the {{'answers':..., 'notes':...}} structure: {raw_answers_output}. Treating as empty answers.")
@@ -678,7 +900,11 @@ def process_exam_pdfs(question_pdf_path: str, answer_pdf_path: str, processed_pr
     }
 
     # 5. 存 processed_data (只存 parsed JSON)
-    save_processed_data(combined_data, str(output_parsed_filepath)) # Ensure path is string for os.makedirs
+    # 先移除舊的來源記錄，寫檔成功後才記下本次來源；中途失敗時不會把別份結果當成本次的輸出
+    source_record_path = get_processed_source_path(output_parsed_filepath)
+    _remove_cache_file(source_record_path)
+    if save_processed_data(combined_data, str(output_parsed_filepath)) and source_key is not None: # Ensure path is string for os.makedirs
+        save_cache_key(source_key, source_record_path)
     
     logger.info(f"Process complete for exam based on {os.path.basename(question_pdf_path)}")
     logger.info(f"Parsed data saved to: {output_parsed_filepath}")
@@ -688,8 +914,272 @@ def process_exam_pdfs(question_pdf_path: str, answer_pdf_path: str, processed_pr
 
 # 8. 新增：逐頁解析題目並提取圖片的函數
 
+def _associate_stem_images(
+    stem_spans: List[Optional[Tuple[float, float, float]]],
+    first_option_y0s: List[float],
+    img_x0s: List[float],
+    img_y0s: List[float],
+    img_x1s: List[float],
+    img_y1s: List[float],
+) -> List[int]:
+    """
+    為每個題幹找出下方最近的圖片，返回每題的圖片索引 (找不到為 -1)。
+    只處理純數值：題幹 (x0, x1, y1)、第一個選項的 y0，以及依 y0 排序的圖片座標平行列表。
+    圖片需在題幹下方 150pt 內、與題幹水平重疊，且下緣在第一個選項之上。
+    """
+    best_img_indices = []
+    for stem_span, first_option_y0 in zip(stem_spans, first_option_y0s):
+        best_img_idx = -1
+        # 寬度為 0 (或負) 的題幹不可能與任何圖片水平重疊，整題跳過
+        if stem_span is not None and stem_span[0] < stem_span[1]:
+            stem_x0, stem_x1, stem_y1 = stem_span
+            # 第一張 y0 > 題幹下緣的圖片起往下看；圖片已依 y0 排序，
+            # 所以第一張通過檢查的就是距離題幹最近者，超出 150pt 即可停止
+            for img_idx in range(bisect_right(img_y0s, stem_y1), len(img_y0s)):
+                if img_y0s[img_idx] - stem_y1 >= 150:
+                    break
+                img_x0, img_x1 = img_x0s[img_idx], img_x1s[img_idx]
+                # 單一 AABB 檢查：水平有重疊 (圖片寬度 > 0) 且圖片下緣在第一個選項之上 (無選項時為 inf)
+                if (img_x0 < stem_x1 and stem_x0 < img_x1 and img_x0 < img_x1
+                        and img_y1s[img_idx] < first_option_y0):
+                    best_img_idx = img_idx
+                    break
+        best_img_indices.append(best_img_idx)
+    return best_img_indices
+
+def _save_page_images(
+    doc: fitz.Document,
+    page: fitz.Page,
+    page_actual_number: int,
+    pdf_path: str,
+    current_exam_images_dir: Path,
+    original_pdf_filename_no_ext: str,
+    image_writer: ThreadPoolExecutor,
+    existing_image_names: Optional[AbstractSet[str]] = None,
+) -> List[Tuple[float, float, float, float, str]]:
+    """
+    保存單一頁面的所有圖片 (已存在的檔案不重寫)。
+    Returns:
+        本頁圖片 (x0, y0, x1, y1, 相對路徑) 列表 (依原順序)
+    """
+    page_image_data_list = [] # 存儲本頁提取出的所有圖片：(x0, y0, x1, y1, 相對路徑) tuple
+
+    img_list = page.get_images(full=True)
+    # 圖片都在同一目錄下：相對於 PROCESSED_DATA_DIR 的目錄 (POSIX 分隔) 每頁只算一次，每張圖只接上檔名
+    relative_images_dir_posix = Path(os.path.relpath(current_exam_images_dir, PROCESSED_DATA_DIR)).as_posix() if img_list else ""
+    png_bytes_by_xref: Dict[int, bytes] = {} # xref -> PNG bytes
+    for img_index, img_info in enumerate(img_list):
+        xref = img_info[0]
+        try:
+            # 文件名格式: {原始PDF文件名(不含副檔名)}-page{頁數}-img{圖片索引}.png
+            image_filename = f"{original_pdf_filename_no_ext}-page{page_actual_number}-img{img_index}.png"
+            image_save_path = current_exam_images_dir / image_filename
+            img_bbox_on_page = page.get_image_bbox(img_info)
+
+            # 只有需要寫檔時才解碼圖片；同一 xref 在本頁重複出現時沿用已編碼的 PNG
+            if existing_image_names is not None:
+                image_needs_writing = image_filename not in existing_image_names
+            else:
+                image_needs_writing = not os.path.exists(image_save_path)
+            if image_needs_writing:
+                png_bytes = png_bytes_by_xref.get(xref)
+                if png_bytes is None:
+                    pix = pix_rgb = None
+                    try:
+                        pix = fitz.Pixmap(doc, xref)
+                        # PNG 編碼在主執行緒完成，寫檔交給 image_writer，與後續頁面的解析重疊
+                        if pix.n - pix.alpha < 4: # GRAY (1) or RGB (3): 直接以原色彩空間寫 PNG，灰階不擴成 RGB
+                            png_bytes = pix.tobytes("png")
+                        else: # CMYK: 只有這裡需要多一份 RGB Pixmap
+                            pix_rgb = fitz.Pixmap(fitz.csRGB, pix)
+                            png_bytes = pix_rgb.tobytes("png")
+                    finally:
+                        pix = pix_rgb = None # 編碼失敗時也立即釋放 Pixmap 的像素緩衝
+                    png_bytes_by_xref[xref] = png_bytes
+                image_writer.submit(save_image_bytes, png_bytes, image_save_path)
+            
+            # Path relative to PROCESSED_DATA_DIR with platform-independent separators (forward slashes)
+            relative_image_path_posix = (
+                image_filename if relative_images_dir_posix == "." else f"{relative_images_dir_posix}/{image_filename}"
+            )
+
+            # Store the bbox as plain floats plus the relative POSIX path
+            page_image_data_list.append((
+                img_bbox_on_page.x0, img_bbox_on_page.y0, img_bbox_on_page.x1, img_bbox_on_page.y1,
+                relative_image_path_posix
+            ))
+            logger.debug(f"Saved image {image_filename} from page {page_actual_number}")
+            
+        except Exception as e:
+            logger.error(f"Error processing image xref {xref} on page {page_actual_number} of {pdf_path}: {e}")
+
+    return page_image_data_list
+
+def _parse_question_page(
+    doc: fitz.Document,
+    page_num: int,
+    pdf_path: str,
+    current_parsing_mode: str,
+    current_exam_images_dir: Path,
+    original_pdf_filename_no_ext: str,
+    image_writer: ThreadPoolExecutor,
+    existing_image_names: Optional[AbstractSet[str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    解析題目卷的單一頁面：保存本頁圖片、解析題目，並依 BBox 將圖片關聯到題幹。
+    由 parse_questions_from_pdf 逐頁呼叫；頁面相關的暫存資料在返回後即釋放。
+    existing_image_names 為圖片目錄中已存在的檔名 (由呼叫端掃描一次)；未提供時逐張以 os.path.exists 檢查。
+    """
+    page_questions: List[Dict[str, Any]] = []
+
+    # For block matching, we usually want patterns anchored at the start.
+    # OPTION_REGEX_STR itself is suitable for re.match() if we strip the block text first.
+    anchored_option_pattern_for_blocks = _ANCHORED_OPTION_RE # Same as _OPTION_RE for re.match on stripped lines
+
+    # Question start pattern depends on the parsing mode decided by the caller
+    current_question_start_pattern_for_blocks = _QUESTION_START_PATTERNS.get(current_parsing_mode, _DEFAULT_QUESTION_START_RE)
+
+    # 逐頁載入，函數返回即釋放，讓記憶體峰值只取決於單頁
+    page = doc.load_page(page_num)
+    page_actual_number = page_num + 1
+
+    # 2. 提取本頁文本塊 (此部分保留，因為獲取文本塊本身是有用的)
+    # 建立一次 TextPage，只抽取一次 "blocks"：未排序的文字塊依序串接即為 get_text("text") 的內容，
+    # 排序 (同 sort=True 的 (y1, x0)) 後再供題幹 BBox 使用，不必再序列化一次整頁文字
+    textpage = page.get_textpage(flags=fitz.TEXTFLAGS_BLOCKS)
+    raw_blocks = page.get_text("blocks", textpage=textpage)
+    textpage = None
+    # 文本塊以平行列表 (SoA) 保存，只保留有文字的區塊；座標直接取自 block tuple，不建立 fitz.Rect
+    block_x0s: List[float] = []
+    block_y0s: List[float] = []
+    block_x1s: List[float] = []
+    block_y1s: List[float] = []
+    block_lines: List[List[str]] = [] # 每塊的非空行 (已 strip)，只在這裡切一次
+    for block_tuple in sorted(raw_blocks, key=itemgetter(3, 0)):
+        if block_tuple[6] != 0: # 只處理 TEXT block
+            continue
+        block_text_stripped_lines = [line.strip() for line in block_tuple[4].splitlines() if line.strip()]
+        if not block_text_stripped_lines:
+            continue
+        block_x0s.append(block_tuple[0])
+        block_y0s.append(block_tuple[1])
+        block_x1s.append(block_tuple[2])
+        block_y1s.append(block_tuple[3])
+        block_lines.append(block_text_stripped_lines)
+
+    # 沒有任何文字的頁面 (掃描圖片頁等)：沒有題幹可關聯，跳過圖片、文字抽取與題目解析
+    if not block_lines:
+        logger.info(f"[Page {page_actual_number}] No text layer found (image-only page). Skipping text parsing for this page.")
+        return page_questions
+    
+    # 3. 使用您現有的 parse_questions_from_pdf_text 解析本頁題目結構 (Existing)
+    page_text_for_parser = "".join(block_tuple[4] for block_tuple in raw_blocks if block_tuple[6] == 0)
+    logger.debug(f"--- Page {page_actual_number} Raw Text for Parser ---")
+    logger.debug(page_text_for_parser[:1000]) # Log first 1000 chars of page text
+    logger.debug("--- End of Page Raw Text ---")
+    
+    questions_text_data = parse_questions_from_pdf_text(
+        page_text_for_parser,
+        parsing_mode=current_parsing_mode,
+        question_start_pattern=current_question_start_pattern_for_blocks,
+        option_pattern=_OPTION_RE,
+    )
+    
+    if not questions_text_data:
+        # 沒有題目的頁面 (封面、說明頁等) 不會有題幹可關聯圖片，連圖片都不必解碼、保存
+        logger.warning(f"[Page {page_actual_number}] No questions parsed by parse_questions_from_pdf_text. Skipping image extraction and BBox association for this page.")
+        return page_questions
+
+    # 3b. 本頁有題目時才提取並保存本頁所有圖片
+    page_image_data_list = _save_page_images(
+        doc, page, page_actual_number, pdf_path, current_exam_images_dir,
+        original_pdf_filename_no_ext, image_writer, existing_image_names
+    )
+    # 依圖片上緣 y0 排序 (穩定排序，y0 相同時保持原順序)，之後以 bisect 只檢查題幹下方 150pt 內的圖片
+    page_image_data_list.sort(key=itemgetter(1))
+    # 圖片座標拆成平行列表 (SoA)，每題比對時只做純 float 比較
+    page_image_x0s = [img_item[0] for img_item in page_image_data_list]
+    page_image_y0s = [img_item[1] for img_item in page_image_data_list]
+    page_image_x1s = [img_item[2] for img_item in page_image_data_list]
+    page_image_y1s = [img_item[3] for img_item in page_image_data_list]
+
+    # 4. 針對每個解析出的題目，查找其 BBox 並重新關聯圖片
+    # 先對本頁文本塊做一次預掃描：記錄每塊首行的題號、首行是否為選項，
+    # 以及題號塊本身是否已含選項。之後每題直接定位自己的題號塊與題幹終點，不必對整頁重跑 regex。
+    block_has_option: List[bool] = [] # 題號塊本身 (題號後或其餘行) 是否已含選項
+    block_indices_by_q: Dict[int, List[int]] = {} # 題號 -> 以該題號開頭的區塊索引 (遞增)
+    option_block_indices: List[int] = [] # 首行為選項的區塊索引 (遞增)
+    for block_idx, block_text_stripped_lines in enumerate(block_lines):
+        first_line_of_block = block_text_stripped_lines[0]
+        stem_block_has_option = False
+        q_start_match = current_question_start_pattern_for_blocks.match(first_line_of_block)
+        if q_start_match:
+            q_rest = q_start_match.group(2).strip()
+            if anchored_option_pattern_for_blocks.match(q_rest):
+                stem_block_has_option = True
+            else:
+                for L_idx, line_in_block in enumerate(block_text_stripped_lines):
+                    if L_idx == 0 and q_rest: continue
+                    if anchored_option_pattern_for_blocks.match(line_in_block):
+                        stem_block_has_option = True
+                        break
+            block_indices_by_q.setdefault(int(q_start_match.group(1)), []).append(block_idx)
+        if anchored_option_pattern_for_blocks.match(first_line_of_block):
+            option_block_indices.append(block_idx)
+        block_has_option.append(stem_block_has_option)
+
+    # 先找出每題的題幹範圍與第一個選項的 y0，再一次完成整頁的圖片關聯
+    stem_spans: List[Optional[Tuple[float, float, float]]] = [] # 每題 (x0, x1, y1)，找不到題幹為 None
+    first_option_y0s: List[float] = []
+    block_count = len(block_lines)
+    for q_text_data in questions_text_data:
+        q_num_as_int = q_text_data['question_number']
+        first_option_y0_for_q = math.inf
+        
+        q_block_indices = block_indices_by_q.get(q_num_as_int)
+        if q_block_indices:
+            start_block_idx = q_block_indices[0] # 同題號只認第一個區塊
+            if block_has_option[start_block_idx]:
+                stem_stop_idx = start_block_idx + 1
+                first_option_y0_for_q = block_y0s[start_block_idx]
+            else:
+                # 題幹延續到之後第一個選項塊，或下一題 (題號 +1) 的題號塊為止 (同一塊時以選項為準)；
+                # 兩者的位置都用 bisect 直接找出，不逐塊判斷
+                option_pos = bisect_right(option_block_indices, start_block_idx)
+                stop_at_option = option_block_indices[option_pos] if option_pos < len(option_block_indices) else block_count
+                next_q_block_indices = block_indices_by_q.get(q_num_as_int + 1, [])
+                next_q_pos = bisect_right(next_q_block_indices, start_block_idx)
+                stop_at_next_q = next_q_block_indices[next_q_pos] if next_q_pos < len(next_q_block_indices) else block_count
+                stem_stop_idx = min(stop_at_option, stop_at_next_q)
+                if stop_at_option < block_count and stop_at_option <= stop_at_next_q:
+                    first_option_y0_for_q = block_y0s[stop_at_option]
+            # 題幹各區塊的聯集 (圖片關聯只需左右邊界與下緣)
+            stem_spans.append((
+                min(block_x0s[start_block_idx:stem_stop_idx]),
+                max(block_x1s[start_block_idx:stem_stop_idx]),
+                max(block_y1s[start_block_idx:stem_stop_idx]),
+            ))
+        else:
+            stem_spans.append(None) # Stem not found, so no image association
+        first_option_y0s.append(first_option_y0_for_q)
+
+    best_img_indices = _associate_stem_images(
+        stem_spans, first_option_y0s,
+        page_image_x0s, page_image_y0s, page_image_x1s, page_image_y1s
+    )
+
+    for q_text_data, best_img_idx in zip(questions_text_data, best_img_indices):
+        current_q_dict = q_text_data.copy()
+        # Store the relative path string, or None when no image (or no stem) was found
+        current_q_dict['image_path'] = page_image_data_list[best_img_idx][4] if best_img_idx >= 0 else None
+        current_q_dict['page_number'] = page_actual_number
+        page_questions.append(current_q_dict)
+
+    return page_questions
+
 def parse_questions_from_pdf(
     pdf_path: str,
+    doc: Optional[fitz.Document] = None,
     # base_output_dir: str, # 例如: "processed_data" 或測試時的 "test_processed_data" --- 會被重新定義
     # test_id_for_images: str, # 例如: "111_first_biochemistry" ---不再需要，由pdf_path推斷
     # 以下參數將傳遞給您現有的 parse_questions_from_pdf_text
@@ -703,6 +1193,7 @@ def parse_questions_from_pdf(
 
     Args:
         pdf_path: PDF 文件的路徑。
+        doc: 可選，已開啟的同一份 PDF；傳入時直接使用且不會關閉 (由呼叫端負責)，否則依 pdf_path 開啟。
         # base_output_dir: 將被內部設置為 PROJECT_ROOT / "processed_data"
         # test_id_for_images: 不再使用
 
@@ -714,11 +1205,13 @@ def parse_questions_from_pdf(
     # 重新定義基礎輸出目錄的根 - 使用從 config 導入的 PROCESSED_DATA_DIR
     actual_image_root_dir = PROCESSED_DATA_DIR / "image" # 新的根目錄
 
-    try:
-        doc = fitz.open(pdf_path)
-    except Exception as e:
-        logger.error(f"Error opening PDF {pdf_path}: {e}")
-        return all_parsed_questions_data
+    owns_doc = doc is None # 只關閉自己開啟的 Document
+    if owns_doc:
+        try:
+            doc = fitz.open(pdf_path)
+        except Exception as e:
+            logger.error(f"Error opening PDF {pdf_path}: {e}")
+            return all_parsed_questions_data
 
     # 從 pdf_path 中提取科目、年份等結構化路徑和原始文件名
     try:
@@ -761,163 +1254,43 @@ def parse_questions_from_pdf(
     logger.info(f"Images for {pdf_path} will be saved in: {current_exam_images_dir}")
 
 
-    # Compile OPTION_RE_ANCHORED for block parsing if needed, or use OPTION_REGEX_STR directly with re.match
-    # For block matching, we usually want patterns anchored at the start.
-    # OPTION_REGEX_STR itself is suitable for re.match() if we strip the block text first.
-    anchored_option_pattern_for_blocks = re.compile(OPTION_REGEX_STR) # Same as OPTION_RE_STR for re.match on stripped lines
-
-    # Determine parsing mode for question_start_pattern
     current_parsing_mode = determine_parsing_mode(pdf_path)
-    if current_parsing_mode == "strict_start":
-        current_question_start_pattern_for_blocks = re.compile(STRICT_QUESTION_START_REGEX_STR)
-    else:
-        current_question_start_pattern_for_blocks = re.compile(DEFAULT_QUESTION_START_REGEX_STR)
 
-    for page_num, page in enumerate(doc):
-        page_actual_number = page_num + 1
-        page_image_data_list = [] # 存儲本頁提取出的所有圖片的路徑和 bounding boxes
-
-        # 1. 提取並保存本頁所有圖片
-        img_list = page.get_images(full=True)
-        for img_index, img_info in enumerate(img_list):
-            xref = img_info[0]
-            try:
-                pix = fitz.Pixmap(doc, xref)
-                # 文件名格式: {原始PDF文件名(不含副檔名)}-page{頁數}-img{圖片索引}.png
-                image_filename = f"{original_pdf_filename_no_ext}-page{page_actual_number}-img{img_index}.png"
-                image_save_path = current_exam_images_dir / image_filename
-                img_bbox_on_page = page.get_image_bbox(img_info)
-
-                if pix.n - pix.alpha < 4: # not CMYK or GRAY
-                    if not os.path.exists(image_save_path):
-                        pix.save(image_save_path)
-                else: # CMYK: convert to RGB first
-                    if not os.path.exists(image_save_path):
-                        pix_rgb = fitz.Pixmap(fitz.csRGB, pix)
-                        pix_rgb.save(image_save_path)
-                        pix_rgb = None # Release memory
-                
-                # Convert absolute image_save_path to be relative to PROCESSED_DATA_DIR
-                relative_image_path = os.path.relpath(image_save_path, PROCESSED_DATA_DIR)
-                # Ensure platform-independent path separators (forward slashes)
-                relative_image_path_posix = Path(relative_image_path).as_posix()
-
-                page_image_data_list.append({
-                    "path": relative_image_path_posix, # Store the relative POSIX path
-                    "bbox": img_bbox_on_page
-                })
-                pix = None
-                logger.debug(f"Saved image {image_filename} from page {page_actual_number}")
-                
-            except Exception as e:
-                logger.error(f"Error processing image xref {xref} on page {page_actual_number} of {pdf_path}: {e}")
-
-        # 2. 提取本頁文本塊 (此部分保留，因為獲取文本塊本身是有用的)
-        text_blocks_on_page = []
-        raw_blocks = page.get_text("blocks", sort=True) 
-        for block_tuple in raw_blocks:
-            if block_tuple[6] == 0: # TEXT block
-                text_blocks_on_page.append({
-                    "text": block_tuple[4],
-                    "bbox": fitz.Rect(block_tuple[0:4])
-                })
-        
-        # 3. 使用您現有的 parse_questions_from_pdf_text 解析本頁題目結構 (Existing)
-        page_text_for_parser = page.get_text("text") 
-        logger.debug(f"--- Page {page_actual_number} Raw Text for Parser ---")
-        logger.debug(page_text_for_parser[:1000]) # Log first 1000 chars of page text
-        logger.debug("--- End of Page Raw Text ---")
-        
-        questions_text_data = parse_questions_from_pdf_text(page_text_for_parser, parsing_mode=current_parsing_mode)
-        
-        if not questions_text_data:
-            logger.warning(f"[Page {page_actual_number}] No questions parsed by parse_questions_from_pdf_text. Skipping BBox association for this page.")
-
-        # 4. 針對每個解析出的題目，查找其 BBox 並重新關聯圖片
-        for q_text_data in questions_text_data:
-            current_q_dict = q_text_data.copy()
-            current_q_dict['image_path'] = None # Reset from previous basic association
-            current_q_dict['page_number'] = page_actual_number
-            
-            q_num_as_int = current_q_dict['question_number']
-            
-            stem_found_blocks = []
-            first_option_y0_for_q = float('inf')
-            active_question_parsing_state = "looking_for_stem_start"
-            
-            for block_idx, block_item in enumerate(text_blocks_on_page):
-                block_text_content = block_item["text"]
-                block_text_stripped_lines = [line.strip() for line in block_text_content.splitlines() if line.strip()]
-                if not block_text_stripped_lines:
-                    continue
-                first_line_of_block = block_text_stripped_lines[0]
-
-                if active_question_parsing_state == "looking_for_stem_start":
-                    q_start_match = current_question_start_pattern_for_blocks.match(first_line_of_block)
-                    if q_start_match and int(q_start_match.group(1)) == q_num_as_int:
-                        active_question_parsing_state = "in_stem"
-                        stem_found_blocks.append(block_item["bbox"])
-                        option_match_in_same_block = anchored_option_pattern_for_blocks.match(q_start_match.group(2).strip())
-                        if not option_match_in_same_block:
-                             for L_idx, line_in_block in enumerate(block_text_stripped_lines):
-                                 if L_idx == 0 and q_start_match.group(2).strip(): continue
-                                 if anchored_option_pattern_for_blocks.match(line_in_block):
-                                     first_option_y0_for_q = min(first_option_y0_for_q, block_item["bbox"].y0)
-                                     active_question_parsing_state = "looking_for_options"
-                                     break 
-                             if active_question_parsing_state == "looking_for_options": break
-                        else: 
-                            first_option_y0_for_q = min(first_option_y0_for_q, block_item["bbox"].y0)
-                            active_question_parsing_state = "looking_for_options"
-                            break
-                elif active_question_parsing_state == "in_stem":
-                    option_match = anchored_option_pattern_for_blocks.match(first_line_of_block)
-                    if option_match:
-                        first_option_y0_for_q = min(first_option_y0_for_q, block_item["bbox"].y0)
-                        active_question_parsing_state = "looking_for_options"
-                        break
-                    next_q_match = current_question_start_pattern_for_blocks.match(first_line_of_block)
-                    if next_q_match and int(next_q_match.group(1)) == q_num_as_int + 1:
-                        active_question_parsing_state = "looking_for_stem_start"
-                        break
-                    stem_found_blocks.append(block_item["bbox"])
-
-            main_stem_bbox = None
-            if stem_found_blocks:
-                main_stem_bbox = stem_found_blocks[0]
-                for bbox in stem_found_blocks[1:]:
-                    main_stem_bbox.include_rect(bbox)
-            
-            if main_stem_bbox: # Only proceed if stem was found
-                best_img_path_for_q = None
-                min_v_dist_to_stem = float('inf')
-
-                for img_item in page_image_data_list:
-                    img_bbox = img_item["bbox"]
-                    image_starts_below_stem = img_bbox.y0 > main_stem_bbox.y1
-                    horizontal_overlap = (max(main_stem_bbox.x0, img_bbox.x0) < min(main_stem_bbox.x1, img_bbox.x1))
-
-                    if image_starts_below_stem and horizontal_overlap:
-                        image_ends_above_options = True
-                        if first_option_y0_for_q != float('inf'):
-                            if img_bbox.y1 >= first_option_y0_for_q:
-                                image_ends_above_options = False
-                        
-                        if image_ends_above_options:
-                            vertical_distance = img_bbox.y0 - main_stem_bbox.y1
-                            if 0 <= vertical_distance < 150: 
-                                if vertical_distance < min_v_dist_to_stem:
-                                    min_v_dist_to_stem = vertical_distance
-                                    best_img_path_for_q = img_item["path"] # Store the path string
-                
-                current_q_dict['image_path'] = best_img_path_for_q
-            else:
-                current_q_dict['image_path'] = None # Stem not found, so no image association
-            
-            all_parsed_questions_data.append(current_q_dict)
+    # 同一份 PDF (內容雜湊相同) 且輸出位置、解析模式相同時，直接使用上次的解析結果
+    cache_path = get_question_cache_path(current_exam_images_dir, current_parsing_mode)
+    cache_key = get_question_cache_key(pdf_path)
+    cached_questions = load_cached_questions(cache_path, cache_key) if cache_key else None
+    if cached_questions is not None:
+        if owns_doc:
+            doc.close()
+        logger.info(f"Loaded {len(cached_questions)} cached questions for {pdf_path} from {cache_path}")
+        return cached_questions
+
+    # 圖片目錄只掃描一次 (一次 scandir)，各頁以檔名集合判斷圖片是否已存在，不必每張圖各 stat 一次
+    try:
+        with os.scandir(current_exam_images_dir) as dir_entries:
+            existing_image_names: Optional[AbstractSet[str]] = frozenset(entry.name for entry in dir_entries)
+    except OSError as e:
+        logger.warning(f"Could not list {current_exam_images_dir}: {e}. Falling back to per-image existence checks.")
+        existing_image_names = None
+
+    # 逐頁處理：每頁的文本塊、圖片 bbox 等都是 _parse_question_page 的區域變數，返回即釋放，
+    # 只保留本頁的題目 dict。離開 with 時等待所有圖片寫入磁碟 (出錯時也一樣)；自己開啟的 Document 在 finally 關閉
+    try:
+        with ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as image_writer:
+            for page_num in range(doc.page_count):
+                page_questions = _parse_question_page(
+                    doc, page_num, pdf_path, current_parsing_mode,
+                    current_exam_images_dir, original_pdf_filename_no_ext, image_writer, existing_image_names
+                )
+                all_parsed_questions_data.extend(page_questions)
+    finally:
+        if owns_doc:
+            doc.close()
 
-    doc.close()
     logger.info(f"Finished parsing {pdf_path}. Total questions extracted: {len(all_parsed_questions_data)}")
+    if cache_key:
+        save_cached_questions(all_parsed_questions_data, cache_path, cache_key)
     return all_parsed_questions_data
 
 # --- Helper Functions ---
@@ -925,31 +1298,159 @@ def normalize_full_width_alpha(text: str) -> str:
     """Converts full-width Latin alphabet characters in a string to half-width."""
     if not text:
         return ""
-    normalized_chars = []
-    for char_val in [ord(c) for c in text]:
-        if 0xFF21 <= char_val <= 0xFF3A:  # Full-width A-Z
-            normalized_chars.append(chr(char_val - 0xFEE0))
-        elif 0xFF41 <= char_val <= 0xFF5A: # Full-width a-z
-            normalized_chars.append(chr(char_val - 0xFEE0))
-        else:
-            normalized_chars.append(chr(char_val))
-    return "".join(normalized_chars)
+    return text.translate(_FULLWIDTH_ALPHA_TO_ASCII) # Full-width A-Z / a-z，其餘字元不變
 
 def sanitize_for_filesystem(name: str) -> str:
     """Sanitizes a string to be used as a filename or directory name."""
     if not name:
         return "untitled"
     # Replace common problematic characters with underscore
-    name = re.sub(r'[\\\\/:*?"<>|]', '_', name)
+    name = name.translate(_FS_UNSAFE_TO_UNDERSCORE)
     # Remove leading/trailing whitespace and dots, and control characters
     name = name.strip(" .\\t\\n\\r\\f\\v")
-    name = re.sub(r'[\\x00-\\x1F\\x7F]', '', name) # Remove control characters
+    name = name.translate(_FS_CONTROL_CHARS_DELETE) # Remove control characters
     # Reduce multiple underscores to one
-    name = re.sub(r'_+', '_', name)
+    name = _FS_UNDERSCORE_RUN_RE.sub('_', name)
     # Limit length
     return name[:150]
 
-if __name__ == "__main__":
+@lru_cache(maxsize=1)
+def _parser_source_digest() -> Optional[str]:
+    """本模組原始碼的 SHA1。解析邏輯一改，快取鍵就跟著變，舊快取自動失效；讀不到原始碼時返回 None (不使用快取)。"""
+    try:
+        with open(__file__, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError as e:
+        logger.warning(f"Could not read parser source for the parse cache key: {e}")
+        return None
+
+def get_question_cache_path(images_dir: Path, parsing_mode: str) -> Path:
+    """
+    返回題目卷的快取檔路徑。每個輸出位置 (圖片目錄 + 解析模式) 只對應一個快取檔，
+    PDF 被替換或解析邏輯改變時直接覆寫，不會在快取目錄中累積舊檔。
+    """
+    slot = hashlib.sha1(f"{Path(images_dir).as_posix()}|{parsing_mode}".encode("utf-8")).hexdigest()
+    return PROCESSED_DATA_DIR / PARSE_CACHE_SUBDIR / f"{slot}.json"
+
+def _hash_sources(pdf_paths: Iterable[str]) -> Optional[str]:
+    """
+    以各 PDF 的內容與本模組原始碼的 SHA1 組成快取鍵。
+    讀檔失敗時返回 None (不使用快取)。
+    """
+    parser_digest = _parser_source_digest()
+    if parser_digest is None:
+        return None
+    hasher = hashlib.sha1()
+    for pdf_path in pdf_paths:
+        try:
+            with open(pdf_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+        except OSError as e:
+            logger.warning(f"Could not hash {pdf_path} for the parse cache: {e}")
+            return None
+        hasher.update(b"|")
+    hasher.update(parser_digest.encode("utf-8"))
+    return hasher.hexdigest()
+
+def get_question_cache_key(pdf_path: str) -> Optional[str]:
+    """題目卷解析快取的鍵：PDF 內容與本模組原始碼的 SHA1，存在快取檔內供比對。"""
+    return _hash_sources((pdf_path,))
+
+def get_processed_source_key(question_pdf_path: str, answer_pdf_path: str) -> Optional[str]:
+    """parsed JSON 的來源鍵：題目卷、答案卷的路徑與內容，加上本模組原始碼的 SHA1。"""
+    # 元數據的備援值取自檔名，路徑也算來源的一部分
+    key = _hash_sources((question_pdf_path, answer_pdf_path))
+    if key is None:
+        return None
+    return hashlib.sha1(f"{key}|{question_pdf_path}|{answer_pdf_path}".encode("utf-8")).hexdigest()
+
+def get_processed_source_path(out_path: Union[str, Path]) -> Path:
+    """返回記錄 parsed JSON 來源鍵的檔案路徑 (位於快取目錄，每個輸出檔對應一個)。"""
+    slot = hashlib.sha1(Path(out_path).as_posix().encode("utf-8")).hexdigest()
+    return PROCESSED_DATA_DIR / PARSE_CACHE_SUBDIR / f"{slot}.source.json"
+
+def _load_cache_key(record_path: Path) -> Optional[str]:
+    """讀取來源記錄檔中的鍵；不存在或損壞時返回 None。"""
+    try:
+        with open(record_path, 'r', encoding='utf-8') as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return record.get("key") if isinstance(record, dict) else None
+
+def save_cache_key(cache_key: str, record_path: Path):
+    """將來源鍵寫入記錄檔 (原子寫入)。"""
+    try:
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic({"key": cache_key}, record_path)
+    except IOError as e:
+        logger.error(f"Error writing source record {record_path}: {e}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while writing source record {record_path}: {e}")
+
+def _remove_cache_file(path: Path):
+    """刪除快取/記錄檔；不存在時略過。"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove {path}: {e}")
+
+def load_cached_questions(cache_path: Path, cache_key: str) -> Optional[List[Dict[str, Any]]]:
+    """讀取快取的題目列表；快取不存在、損壞、鍵不符 (PDF 或解析邏輯已改變)，或其引用的圖片已不存在時返回 None。"""
+    if not cache_path.exists():
+        return None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache_entry = json.load(f)
+    except (IOError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable parse cache {cache_path}: {e}")
+        return None
+    if not isinstance(cache_entry, dict) or cache_entry.get("key") != cache_key:
+        logger.info(f"Parse cache {cache_path} is stale; re-parsing.")
+        return None
+    cached_questions = cache_entry.get("questions")
+    if not isinstance(cached_questions, list):
+        return None
+    missing_image = _find_missing_image(cached_questions)
+    if missing_image is not None:
+        logger.info(f"Cached image {missing_image} is missing; re-parsing instead of using {cache_path}")
+        return None
+    return cached_questions
+
+def _find_missing_image(questions: List[Dict[str, Any]]) -> Optional[str]:
+    """返回第一個已不存在的題目圖片 image_path；全部存在時返回 None。"""
+    # 每個圖片目錄只列一次檔名，之後以集合判斷，不必對每張引用的圖片各 stat 一次
+    names_by_dir: Dict[Path, AbstractSet[str]] = {}
+    for q in questions:
+        if not q.get("image_path"):
+            continue
+        image_file = PROCESSED_DATA_DIR / q["image_path"]
+        dir_names = names_by_dir.get(image_file.parent)
+        if dir_names is None:
+            try:
+                dir_names = frozenset(os.listdir(image_file.parent))
+            except OSError:
+                dir_names = frozenset() # 目錄不存在：其下的圖片都視為缺失
+            names_by_dir[image_file.parent] = dir_names
+        if image_file.name not in dir_names:
+            return q["image_path"]
+    return None
+
+def save_cached_questions(questions: List[Dict[str, Any]], cache_path: Path, cache_key: str):
+    """將題目列表連同快取鍵寫入快取檔 (原子寫入，覆寫同一輸出位置的舊快取)。"""
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic({"key": cache_key, "questions": questions}, cache_path)
+    except IOError as e:
+        logger.error(f"Error writing parse cache {cache_path}: {e}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while writing parse cache {cache_path}: {e}")
+
+def _run_tests():
+    """直接執行本模組時的手動測試：以一組示例題目卷/答案卷跑完整個 process_exam_pdfs 流程。"""
     logger.setLevel(logging.DEBUG) 
     print(" executing pdf_parser.py directly for testing...")
     try:
@@ -992,14 +1493,15 @@ if __name__ == "__main__":
                     if "meta" in merged_output:
                         print(f"Meta: {merged_output['meta']}")
                     if "questions" in merged_output and merged_output["questions"]:
-                        print(f"Total questions in output: {len(merged_output['questions'])}")
+                        snippet_lines = [f"Total questions in output: {len(merged_output['questions'])}"]
                         for i, q_data in enumerate(merged_output["questions"][:2]): # 打印前2條題目
-                            print(f"  Q{q_data.get('question_number')}: {q_data.get('content', 'N/A')[:50]}...")
-                            print(f"    Options: {q_data.get('options', {})}")
-                            print(f"    Correct Answer: {q_data.get('correct_answer_key')}")
-                            print(f"    Notes: {q_data.get('notes')}")
-                            print(f"    Image Path: {q_data.get('image_path')}") 
-                            print(f"    Page Number: {q_data.get('page_number')}")
+                            snippet_lines.append(f"  Q{q_data.get('question_number')}: {q_data.get('content', 'N/A')[:50]}...")
+                            snippet_lines.append(f"    Options: {q_data.get('options', {})}")
+                            snippet_lines.append(f"    Correct Answer: {q_data.get('correct_answer_key')}")
+                            snippet_lines.append(f"    Notes: {q_data.get('notes')}")
+                            snippet_lines.append(f"    Image Path: {q_data.get('image_path')}")
+                            snippet_lines.append(f"    Page Number: {q_data.get('page_number')}")
+                        print("\n".join(snippet_lines)) # 收集後一次輸出
                     else:
                         print("No questions found in the merged output.")
                 else:
@@ -1017,4 +1519,6 @@ if __name__ == "__main__":
         print(f"  Answer PDF path: {test_answer_pdf_path}")
         
     print("\\n--- End of pdf_parser.py execution ---")
-    pass
\ No newline at end of file
+
+if __name__ == "__main__":
+    _run_tests()